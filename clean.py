@@ -1,12 +1,11 @@
-import numpy as np
 import glob
 import os
 import json
-import jsonlines
 import pandas as pd
 
 
 prompt_generation_dir = "raw_data_sanity_cleaned_without_p3/"
+keep_keys = {"source", "prompt", "response"}
 for file in glob.glob(os.path.join(prompt_generation_dir, "*.jsonl")):
     if "clean.jsonl" in file:
         continue
@@ -25,13 +24,8 @@ for file in glob.glob(os.path.join(prompt_generation_dir, "*.jsonl")):
     for item in data:
         if 'source' not in item:
             item['source'] = 'unspecified'
-        if 'model_settings' in item:
-            item.pop('model_settings', None)
-        
-        for key in list(item.keys()):
-            if key not in ['source', 'prompt', 'response']:
-                #print(item[key])
-                item.pop(key, None)
+
+        item = {key: value for key, value in item.items() if key in keep_keys}
         
         if isinstance(item['prompt'], dict):
             if "value" in item["prompt"]:
@@ -70,4 +64,11 @@ for file in glob.glob(os.path.join(prompt_generation_dir, "*.jsonl")):
 
     clean_name = file.split(".jsonl")[0] + "_clean.jsonl"
     print(f"writing to {curr_len} rows to {clean_name}")
-    df.to_json(clean_name, orient="records", lines=True)
\ No newline at end of file
+    # write then rename so data.py never globs a half written *_clean.jsonl
+    partial_name = clean_name + ".partial"
+    try:
+        df.to_json(partial_name, orient="records", lines=True)
+        os.replace(partial_name, clean_name)
+    finally:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
\ No newline at end of file
@@ -5,7 +5,6 @@ import numpy as np
 from tqdm import tqdm
 from read import read_config
 from argparse import ArgumentParser
-from peft import PeftModelForCausalLM
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 def read_jsonl_file(file_path):
@@ -17,7 +16,7 @@ def read_jsonl_file(file_path):
     return data
 
 def setup_model(config):
-    model = AutoModelForCausalLM.from_pretrained(config["model_name"], device_map="auto", torch_dtype=torch.float16, output_hidden_states=True)
+    model = AutoModelForCausalLM.from_pretrained(config["model_name"], device_map="auto", torch_dtype=torch.float16)
     tokenizer = AutoTokenizer.from_pretrained(config["tokenizer_name"])
     added_tokens = tokenizer.add_special_tokens({"bos_token": "<s>", "eos_token": "</s>", "pad_token": "<pad>"})
 
@@ -25,7 +24,9 @@ def setup_model(config):
         model.resize_token_embeddings(len(tokenizer))
 
     if 'lora' in config and config['lora']:
-        model = PeftModelForCausalLM.from_pretrained(model, config["lora_path"], device_map="auto", torch_dtype=torch.float16, return_hidden_states=True)
+        from peft import PeftModelForCausalLM
+
+        model = PeftModelForCausalLM.from_pretrained(model, config["lora_path"], device_map="auto", torch_dtype=torch.float16)
         model.to(dtype=torch.float16)
 
     print(f"Mem needed: {model.get_memory_footprint() / 1024 / 1024 / 1024:.2f} GB")
@@ -47,18 +48,27 @@ def eval_example(model, tokenizer, example, config):
     continuations = []
     tokenized_continuations = []
     trajectories = []
-    for i in range(3):
+    # sample all continuations in one batched generate call so the weights are read once per step
+    with torch.no_grad():
+        outputs = model.generate(input_ids=input['input_ids'],
+                                 max_new_tokens=config["max_new_tokens"],
+                                 min_new_tokens=5,
+                                 temperature=config["temperature"],
+                                 repetition_penalty=1.0,
+                                 do_sample=True,
+                                 num_return_sequences=3,
+                                 pad_token_id=tokenizer.pad_token_id)
+
+    for output in outputs:
+        # shorter samples are right padded to the longest one
+        output = output[output.ne(tokenizer.pad_token_id)]
+        decoded = tokenizer.decode(output, skip_special_tokens=True).strip()
+
         with torch.no_grad():
-            outputs = model.generate(input_ids=input['input_ids'],
-                                     max_new_tokens=config["max_new_tokens"],
-                                     min_new_tokens=5,
-                                     temperature=config["temperature"],
-                                     repetition_penalty=1.0,
-                                     do_sample=True)
-            decoded = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-
-            y = model(input_ids=outputs)
-        trajectory = y.hidden_states[0].detach().cpu().numpy()[0]
+            # hidden_states[0] is the embedding output, look it up directly instead of
+            # re-running the full forward pass over prompt + continuation
+            embeddings = model.get_input_embeddings()(output)
+        trajectory = embeddings.detach().cpu().numpy()
         trajectory = trajectory / np.linalg.norm(trajectory, axis=1, keepdims=True)
         trajectory = np.cumsum(trajectory, axis=0) / np.arange(1, trajectory.shape[0]+1).reshape(-1, 1)
 
@@ -71,27 +81,32 @@ def eval_example(model, tokenizer, example, config):
     gt_input = {k: v.to(model.device) for k, v in gt_input.items()}
 
     nlls = []
-    prev_end_loc = 0
+    n_scored = 0
     stride = 512
     seq_len = gt_input['input_ids'].size(1)
 
     for begin_loc in tqdm(range(input['input_ids'].size(1), gt_input['input_ids'].size(1), stride)):
         end_loc = min(begin_loc + stride, seq_len)
-        trg_len = end_loc - prev_end_loc  # may be different from stride on last loop
         input_ids = gt_input['input_ids'][:, begin_loc:end_loc].to(model.device)
-        target_ids = input_ids.clone()
-        target_ids[:, :-trg_len] = -100
+        # labels are shifted inside the model, so a window of n tokens scores n - 1 of them
+        n_tokens = input_ids.size(1) - 1
+        if n_tokens == 0:
+            break
 
         with torch.no_grad():
-            outputs = model(input_ids, labels=target_ids)
-            neg_log_likelihood = outputs.loss * trg_len
+            outputs = model(input_ids, labels=input_ids)
+            neg_log_likelihood = outputs.loss * n_tokens
 
         nlls.append(neg_log_likelihood)
-        prev_end_loc = end_loc
+        n_scored += n_tokens
         if end_loc == seq_len:
             break
 
-    ppl = torch.exp(torch.stack(nlls).sum() / end_loc).item()
+    # one token references leave nothing to score, report nan instead of aborting the run
+    if n_scored == 0:
+        ppl = float("nan")
+    else:
+        ppl = torch.exp(torch.stack(nlls).sum() / n_scored).item()
     print('ppl: ', ppl)
 
     print(prompt)
@@ -1,5 +1,4 @@
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModelForCausalLM
 from read import read_config
 from argparse import ArgumentParser
 import torch
@@ -17,7 +16,14 @@ def generate(tokenizer, prompt, model, config):
 
     
 def setup_model(config):
-    model = AutoModelForCausalLM.from_pretrained(config["model_name"], device_map="auto", torch_dtype=torch.float16)
+    load_in_8bit = config.get("load_in_8bit", False)
+    if load_in_8bit:
+        try:
+            import bitsandbytes
+        except ImportError:
+            raise ImportError("load_in_8bit requires bitsandbytes, install it with `pip install bitsandbytes`")
+
+    model = AutoModelForCausalLM.from_pretrained(config["model_name"], device_map="auto", torch_dtype=torch.float16, load_in_8bit=load_in_8bit)
     tokenizer = AutoTokenizer.from_pretrained(config["tokenizer_name"])
     added_tokens = tokenizer.add_special_tokens({"bos_token": "<s>", "eos_token": "</s>", "pad_token": "<pad>"})
 
@@ -25,8 +31,12 @@ def setup_model(config):
         model.resize_token_embeddings(len(tokenizer))
 
     if config["lora"]:
+        from peft import PeftModelForCausalLM
+
         model = PeftModelForCausalLM.from_pretrained(model, config["lora_path"], device_map="auto", torch_dtype=torch.float16)
-        model.to(dtype=torch.float16)
+        # int8 weights can't be cast, the non quantized layers are already fp16
+        if not load_in_8bit:
+            model.to(dtype=torch.float16)
 
     print(f"Mem needed: {model.get_memory_footprint() / 1024 / 1024 / 1024:.2f} GB")
         
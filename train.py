@@ -7,7 +7,6 @@ from argparse import ArgumentParser
 from read import read_config
 from accelerate import Accelerator
 from accelerate.utils import DummyScheduler, DummyOptim, set_seed
-from peft import get_peft_model, LoraConfig, TaskType
 from data import load_data
 from torchmetrics import MeanMetric
 from tqdm import tqdm
@@ -58,8 +57,10 @@ def train(accelerator, config):
         
 
     checkpoint = config["gradient_checkpointing"]
+    # low_cpu_mem_usage skips the random init + copy, so weights are only materialized once
     model = AutoModelForCausalLM.from_pretrained(config["model_name"], 
                                                     use_cache=False if checkpoint else True,
+                                                    low_cpu_mem_usage=True,
                                                     trust_remote_code=True) 
 
     if added_tokens > 0:
@@ -69,6 +70,8 @@ def train(accelerator, config):
         model.gradient_checkpointing_enable()
 
     if config["lora"]:
+        from peft import get_peft_model, LoraConfig, TaskType
+
         peft_config = LoraConfig(
             # should R be configurable?
             task_type=TaskType.CAUSAL_LM, inference_mode=False, r=8, lora_alpha=32, lora_dropout=0.1
@@ -99,14 +102,18 @@ def train(accelerator, config):
     # setup for saving training states in case preemption
     accelerator.register_for_checkpointing(scheduler)
 
+    resume_epoch, resume_step = 0, None
     if config["checkpoint"]:
         accelerator.load_state(config["checkpoint"])
         accelerator.print(f"Resumed from checkpoint: {config['checkpoint']}")
-        path = os.path.basename(config["train_args"]["resume_from_checkpoint"])
-        training_difference = os.path.splitext(path)[0]
-        resume_step = int(training_difference.replace("step_", ""))
-        accelerator.skip_first_batches(train_dataloader, resume_step)
-        accelerator.print(f"Resuming from step {resume_step}")
+        # checkpoints are saved as epoch_{epoch}_step_{step}
+        path = os.path.basename(os.path.normpath(config["checkpoint"]))
+        _, resume_epoch, _, resume_step = path.split("_")
+        resume_epoch, resume_step = int(resume_epoch), int(resume_step)
+        # the checkpoint is saved after that batch is trained on, so resume on the next one
+        # skip_first_batches returns a new dataloader, it doesn't advance train_dataloader
+        resumed_dataloader = accelerator.skip_first_batches(train_dataloader, resume_step + 1)
+        accelerator.print(f"Resuming from epoch {resume_epoch} step {resume_step}")
 
     train_loss = MeanMetric().to(model.device)
 
@@ -115,8 +122,13 @@ def train(accelerator, config):
             "gradient_accumulation_steps"
         ]
 
-    for epoch in range(config["num_epochs"]):
-        for step, batch in enumerate(tqdm(train_dataloader)):
+    for epoch in range(resume_epoch, config["num_epochs"]):
+        if epoch == resume_epoch and resume_step is not None:
+            dataloader, start_step = resumed_dataloader, resume_step + 1
+        else:
+            dataloader, start_step = train_dataloader, 0
+
+        for step, batch in enumerate(tqdm(dataloader), start=start_step):
             model.train()
             outputs = model(**batch)
             loss = outputs.loss
@@ -138,7 +150,7 @@ def train(accelerator, config):
             train_loss.update(loss_values["loss"])
 
             if step > 0 and step % config["save_every"] == 0:
-                accelerator.save_state(f"{config['output_dir']}/step_{step}")
+                accelerator.save_state(f"{config['output_dir']}/epoch_{epoch}_step_{step}")
 
             if step > 0 and step % config["eval_every"] == 0:
                 val_loss = evaluate(config, model, val_dataloader)
@@ -163,7 +175,7 @@ def train(accelerator, config):
         accelerator.print(f"Pushing to HF hub")
         accelerator.wait_for_everyone()
         unwrapped_model = accelerator.unwrap_model(model)
-        if accelerator.is_main_process:
+        if accelerator.is_main_process and epoch == 0:
             unwrapped_model.push_to_hub(config["save_name"] + "_first_epoch", private=True)
 
             